@@ -225,7 +225,9 @@ async function getTransactions() {
         });
         console.log('Transactions response status:', response.status);
         if (response.ok) {
-            const transactions = await response.json();
+            // The API returns one page of history: { items, next_before_id }
+            const data = await response.json();
+            const transactions = data.items;
             console.log('Transactions data from backend:', transactions); // Debug log
             console.log('Number of transactions:', transactions.length);
             displayTransactions(transactions);
@@ -501,12 +503,12 @@ function displayTransactions(transactions) {
     table.classList.remove('hidden');
     tbody.innerHTML = '';
     
-    // Sort transactions by timestamp (newest first)
-    const sortedTransactions = transactions.sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
+    // Sort transactions by timestamp (newest first); timestamps are unix seconds
+    const sortedTransactions = transactions.sort((a, b) => b.timestamp - a.timestamp);
     
     sortedTransactions.forEach(tr => {
         const typeClass = tr.transaction_type === 'buy' ? 'profit-negative' : 'profit-positive';
-        const date = new Date(tr.timestamp).toLocaleString();
+        const date = new Date(tr.timestamp * 1000).toLocaleString();
         const row = document.createElement('tr');
         row.innerHTML = `
             <td>
@@ -1,60 +1,148 @@
 # FastAPI application for the trading demo.
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Query, Request, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.exception_handlers import request_validation_exception_handler
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 from pathlib import Path
+from pydantic import BaseModel, Field, StringConstraints, field_validator
+from typing import Annotated, Literal, Optional
 import uvicorn
+import anyio
 import logging
-import random
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
+import orjson
+from cachetools import TTLCache
 import os
 
 # Local modules
 from database import db
-from auth import hash_password, verify_password, generate_token, get_current_user
+from async_database import async_db
+from auth import hash_password, verify_password, needs_rehash, generate_token, get_current_user
 from fastapi import Depends
 
 # Prepare paths and the FastAPI app instance.
 BASE_DIR = Path(__file__).parent.parent
 FRONTEND_DIR = BASE_DIR / 'frontend'
 
-app = FastAPI(title="Resource Exchange Simulator", version="1.0.0")
-CORS(app)  # Allow the web client to call the API
+# orjson encodes the JSON responses much faster than the stdlib json module
+app = FastAPI(title="Resource Exchange Simulator", version="1.0.0", default_response_class=ORJSONResponse)
+# Allow the web client to call the API (preflights are answered by the middleware)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+    allow_credentials=False,
+)
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Short-lived copy of the resource list; cleared whenever prices change
+_res_cache = TTLCache(maxsize=1, ttl=2)
+
+# One PCG64 generator for all price moves, seeded from OS entropy at startup
+rng = np.random.default_rng()
+
+# Set up logging. Records go through a queue and a background thread does the
+# actual writing, so request handlers never block on stderr.
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+# Same layout as basicConfig's default output: level, logger name, message
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(log_queue, log_handler)
+# The queue side only renders the message, so the layout isn't applied twice
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+def start_log_listener():
+    """Start the log-writing thread (not at import, so importing the app starts no threads)."""
+    log_listener.start()
+
+@app.on_event("shutdown")
+def stop_log_listener():
+    """Flush any queued log records before the process exits."""
+    log_listener.stop()
+
+# Request bodies. Pydantic validates these before the endpoint code runs.
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+class RegisterReq(BaseModel):
+    username: NonEmptyStr
+    email: NonEmptyStr
+    password: str = Field(min_length=1)
+
+class LoginReq(BaseModel):
+    # Missing fields fall through to the usual 401 rather than a validation error
+    username: Annotated[str, StringConstraints(strip_whitespace=True)] = ''
+    password: str = ''
+
+class TradeReq(BaseModel):
+    trade_type: Literal['buy', 'sell']
+    resource_symbol: NonEmptyStr
+    quantity: float = Field(gt=0)
+
+    @field_validator('trade_type', mode='before')
+    @classmethod
+    def lowercase_trade_type(cls, value):
+        return value.lower() if isinstance(value, str) else value
+
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request: Request, exc: RequestValidationError):
+    """Report bad request bodies as a 400 with a readable message."""
+    errors = exc.errors()
+    # Query/path parameter errors keep FastAPI's usual 422 with the full error list
+    if any(error['loc'][:1] != ('body',) for error in errors):
+        return await request_validation_exception_handler(request, exc)
+    
+    error = errors[0]
+    # The last loc entry is the field name, or a list index / JSON position for other errors
+    field = error['loc'][-1] if isinstance(error['loc'][-1], str) else 'body'
+    return ORJSONResponse(status_code=400, content={"detail": f"{field}: {error['msg']}"})
+
 # Initial startup logs.
 print("Trading Platform server starting...")
-print("Database initialized automatically")
+# Create tables and seed data, unless the process that started the workers already
+# did it before forking them (gunicorn.conf.py). Setting the flag here also covers
+# the workers spawned by uvicorn.run() in __main__ below
+if not os.getenv('DB_INITIALIZED'):
+    db.init_database()
+    os.environ['DB_INITIALIZED'] = '1'
+    print("Database initialized automatically")
+
+@app.on_event("shutdown")
+async def close_async_db():
+    """Close the worker's long-lived database connections."""
+    await async_db.close()
 
 @app.post("/api/register")
-def register(request_data: dict):
+async def register(request_data: RegisterReq):
     """Create a user account."""
     try:
-        username = request_data.get('username', '').strip()
-        email = request_data.get('email', '').strip()
-        password = request_data.get('password', '')
-        
-        if not username or not email or not password:
-            raise HTTPException(status_code=400, detail="Username, email, and password are required")
+        username = request_data.username
+        email = request_data.email
+        password = request_data.password
         
         # Check if user already exists
-        existing_user = db.get_user_by_username(username)
+        existing_user = await async_db.get_user_by_username(username)
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already registered")
         
-        # Hash password before saving
-        password_hash = hash_password(password)
+        # Hash password before saving (Argon2id is deliberately slow, so keep it off the event loop)
+        password_hash = await anyio.to_thread.run_sync(hash_password, password)
         
         # Create new user
-        user_id = db.create_user(username, email, password_hash)
+        user_id = await async_db.create_user(username, email, password_hash)
         
         # Generate JWT token
         token = generate_token(user_id, username)
         
         # Get user data
-        user_data = db.get_user_by_id(user_id)
+        user_data = await async_db.get_user_by_id(user_id)
         
         return {
             'message': 'User created successfully',
@@ -72,25 +160,30 @@ def register(request_data: dict):
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Registration error: {e}")
+        logger.error("Registration error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/api/login")
-def login(request_data: dict):
+async def login(request_data: LoginReq):
     """Sign a user in."""
     try:
-        username = request_data.get('username', '').strip()
-        password = request_data.get('password', '')
+        username = request_data.username
+        password = request_data.password
         
         # Find user by username
-        user = db.get_user_by_username(username)
+        user = await async_db.get_user_by_username(username)
         if not user:
             raise HTTPException(status_code=401, detail="Incorrect username or password")
         
-        # Verify password
-        if not verify_password(password, user['hashed_password']):
+        # Verify password in a worker thread so other requests keep flowing
+        if not await anyio.to_thread.run_sync(verify_password, password, user['hashed_password']):
             raise HTTPException(status_code=401, detail="Incorrect username or password")
         
+        # Upgrade old bcrypt (or outdated Argon2) hashes now that we know the password
+        if needs_rehash(user['hashed_password']):
+            new_hash = await anyio.to_thread.run_sync(hash_password, password)
+            await async_db.update_user_password(user['id'], new_hash)
+        
         # Generate JWT token
         token = generate_token(user['id'], username)
         
@@ -109,17 +202,17 @@ def login(request_data: dict):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Login error: {e}")
+        logger.error("Login error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/api/me")
-def get_current_user_info(current_user: dict = Depends(get_current_user)):
+async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """Return details for the signed-in user."""
     try:
         user_id = current_user['userId']
         
         # Get user details from database
-        user_data = db.get_user_by_id(user_id)
+        user_data = await async_db.get_user_by_id(user_id)
         if not user_data:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -136,128 +229,89 @@ def get_current_user_info(current_user: dict = Depends(get_current_user)):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Get user error: {e}")
+        logger.error("Get user error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/api/resources")
-def get_resources():
+async def get_resources():
     """Return every available resource."""
     try:
-        resources = db.get_all_resources()
+        # One lookup: the entry could expire between an 'in' check and the read
+        cached = _res_cache.get('all')
+        if cached is not None:
+            return cached
+        
+        resources = await async_db.get_all_resources()
+        _res_cache['all'] = resources
         return resources
     except Exception as e:
-        logger.error(f"Get resources error: {e}")
+        logger.error("Get resources error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/api/update-prices")
-def update_resource_prices():
+async def update_resource_prices():
     """Adjust each resource price by a small random amount."""
     try:
-        resources = db.get_all_resources()
-        updated_count = 0
-        
-        for resource in resources:
-            # Random price change between -5% and +5%
-            change_percent = random.uniform(-0.05, 0.05)
-            new_price = resource['current_price'] * (1 + change_percent)
-            
-            # Update the price in database
-            db.update_resource_price(resource['id'], new_price)
-            updated_count += 1
-        
-        logger.info(f"Updated prices for {updated_count} resources")
+        resources = await async_db.get_all_resources()
+        
+        # Random price change between -5% and +5%, generated for all resources at once
+        ids = np.fromiter((r['id'] for r in resources), dtype=np.int64, count=len(resources))
+        prices = np.fromiter((r['current_price'] for r in resources), dtype=np.float64, count=len(resources))
+        new_prices = prices * (1.0 + rng.uniform(-0.05, 0.05, size=prices.size))
+        
+        # Write every new price in one go; this also patches the trade resource cache
+        # from the rows the UPDATE returns, so the next trade uses the new prices
+        await async_db.update_resource_prices_bulk(list(zip(ids.tolist(), new_prices.tolist())))
+        _res_cache.pop('all', None)
+        updated_count = len(resources)
+        
+        logger.info("Updated prices for %d resources", updated_count)
         return {"message": f"Updated prices for {updated_count} resources", "updated_count": updated_count}
     except Exception as e:
-        logger.error(f"Update prices error: {e}")
+        logger.error("Update prices error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/api/trade")
-def execute_trade(trade_data: dict, current_user: dict = Depends(get_current_user)):
+async def execute_trade(trade: TradeReq, current_user: dict = Depends(get_current_user)):
     """Handle buy and sell requests."""
     try:
         user_id = current_user['userId']
         
-        trade_type = trade_data.get('trade_type', '').lower()
-        resource_symbol = trade_data.get('resource_symbol', '')
-        quantity = float(trade_data.get('quantity', 0))
-        
-        if trade_type not in ['buy', 'sell']:
-            raise HTTPException(status_code=400, detail="trade_type must be 'buy' or 'sell'")
-        
-        if not resource_symbol or quantity <= 0:
-            raise HTTPException(status_code=400, detail="resource_symbol and quantity are required")
-        
-        # Get user and resource
-        user_data = db.get_user_by_id(user_id)
-        resource = db.get_resource_by_symbol(resource_symbol)
-        
-        if not resource:
-            raise HTTPException(status_code=404, detail="Resource not found")
-        
-        price = resource['current_price']
-        total_value = quantity * price
-        
-        if trade_type == 'buy':
-            # Check if user has enough balance
-            if user_data['balance'] < total_value:
-                raise HTTPException(status_code=400, detail="Insufficient balance")
-            
-            # Update user balance
-            new_balance = user_data['balance'] - total_value
-            db.update_user_balance(user_id, new_balance)
-            
-            # Create or update position
-            db.create_or_update_position(user_id, resource['id'], quantity, price)
-            
-        else:  # sell
-            # Check if user has enough quantity
-            position = db.get_position(user_id, resource['id'])
-            if not position or position['quantity'] < quantity:
-                raise HTTPException(status_code=400, detail="Insufficient quantity to sell")
-            
-            # Update user balance
-            new_balance = user_data['balance'] + total_value
-            db.update_user_balance(user_id, new_balance)
-            
-            # Update position (negative quantity for sell)
-            db.create_or_update_position(user_id, resource['id'], -quantity, price)
-        
-        # Create transaction record
-        transaction_id = db.create_transaction(user_id, resource['id'], trade_type, quantity, price, total_value)
-        
-        # Get updated user
-        updated_user = db.get_user_by_id(user_id)
-        
-        logger.info(f"Trade executed - User ID: {user_id}, Type: {trade_type}, Symbol: {resource_symbol}, Quantity: {quantity}")
+        trade_type = trade.trade_type
+        resource_symbol = trade.resource_symbol
+        quantity = trade.quantity
+        
+        # Validation, balance/position updates and the transaction record all happen in one DB transaction
+        transaction_id, new_balance = await async_db.execute_trade_atomic(user_id, resource_symbol, trade_type, quantity)
+        
+        logger.info("Trade executed - User ID: %s, Type: %s, Symbol: %s, Quantity: %s", user_id, trade_type, resource_symbol, quantity)
         
         return {
             "message": "Trade executed successfully",
             "transaction_id": transaction_id,
-            "balance": updated_user['balance']
+            "balance": new_balance
         }
         
     except HTTPException:
         raise
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Trade error: {e}")
+        logger.error("Trade error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/positions")
-def get_positions(current_user: dict = Depends(get_current_user)):
+async def get_positions(current_user: dict = Depends(get_current_user)):
     """Return the user's holdings."""
     try:
         user_id = current_user['userId']
         
-        positions = db.get_user_positions(user_id)
-        result = []
-        
-        # Calculate current value and profit/loss for each position
-        for position in positions:
-            current_value = position['quantity'] * position['current_price']
-            cost_basis = position['quantity'] * position['average_price']
-            profit_loss = current_value - cost_basis
-            
-            result.append({
+        # Current value and profit/loss come back already calculated by the database
+        positions = await async_db.get_user_positions(user_id)
+        result = [
+            {
                 "id": position['id'],
                 "resource": {
                     "id": position['resource_id'],
@@ -267,65 +321,61 @@ def get_positions(current_user: dict = Depends(get_current_user)):
                 },
                 "quantity": position['quantity'],
                 "average_price": position['average_price'],
-                "current_value": current_value,
-                "profit_loss": profit_loss,
+                "current_value": position['current_value'],
+                "profit_loss": position['profit_loss'],
                 "created_at": position['created_at']
-            })
+            }
+            for position in positions
+        ]
         
         return result
         
     except Exception as e:
-        logger.error(f"Get positions error: {e}")
+        logger.error("Get positions error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/api/transactions")
-def get_transactions(current_user: dict = Depends(get_current_user)):
-    """Return the user's trade history."""
+async def get_transactions(
+    current_user: dict = Depends(get_current_user),
+    limit: int = Query(100, ge=1, le=500),
+    before_id: Optional[int] = None,
+):
+    """Return one page of the user's trade history, newest first."""
     try:
         user_id = current_user['userId']
         
-        transactions = db.get_user_transactions(user_id)
+        transactions = await async_db.get_user_transactions(user_id, limit=limit, before_id=before_id)
         
-        logger.info(f"User {user_id} has {len(transactions)} transactions")
+        logger.info("User %s fetched %d transactions", user_id, len(transactions))
         
-        return transactions
+        # A full page means there may be older transactions to fetch with before_id
+        next_before_id = transactions[-1]['id'] if len(transactions) == limit else None
+        return {"items": transactions, "next_before_id": next_before_id}
         
     except Exception as e:
-        logger.error(f"Get transactions error: {e}")
+        logger.error("Get transactions error: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error")
 
-# Serve static files such as CSS and JavaScript.
-@app.get("/style.css")
-def serve_css():
-    """Serve the CSS file."""
-    css_file = FRONTEND_DIR / "style.css"
-    if css_file.exists():
-        return FileResponse(css_file, media_type="text/css")
-    raise HTTPException(status_code=404, detail="CSS file not found")
-
-@app.get("/script.js")
-def serve_js():
-    """Serve the JavaScript file."""
-    js_file = FRONTEND_DIR / "script.js"
-    if js_file.exists():
-        return FileResponse(js_file, media_type="application/javascript")
-    raise HTTPException(status_code=404, detail="JavaScript file not found")
-
-# Serve main HTML file for root
-@app.get("/")
-def serve_index():
-    """Serve the main HTML file."""
-    index_file = FRONTEND_DIR / "index.html"
-    if index_file.exists():
-        with open(index_file, "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    raise HTTPException(status_code=404, detail="Frontend not found")
+@app.get("/api/transactions/export")
+async def export_transactions(current_user: dict = Depends(get_current_user)):
+    """Stream the user's full trade history as NDJSON, one transaction per line."""
+    user_id = current_user['userId']
+    
+    async def ndjson_lines():
+        async for transaction in async_db.iter_user_transactions(user_id):
+            yield orjson.dumps(transaction) + b"\n"
+    
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
 
 @app.get("/api")
-def read_root():
+async def read_root():
     """Give a brief API description."""
     return {"message": "Resource Exchange Simulator API", "docs": "/docs"}
 
+# Serve the frontend (index.html, CSS and JavaScript).
+# Mounted last so it doesn't shadow the /api routes above.
+app.mount("/", StaticFiles(directory=str(FRONTEND_DIR), html=True), name="frontend")
+
 if __name__ == "__main__":
     # Get port from environment variable (for deployment) or use default
     port = int(os.getenv('PORT', 8000))
@@ -333,5 +383,8 @@ if __name__ == "__main__":
     print(f"Starting Trading Platform server on port {port}")
     print(f"Open your browser and navigate to http://localhost:{port}")
     
-    # Run the FastAPI app
-    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=False)
+    # Two worker processes per core plus one (2 * CPUs + 1), override with WEB_CONCURRENCY
+    workers = int(os.getenv('WEB_CONCURRENCY', (os.cpu_count() or 1) * 2 + 1))
+    
+    # Run the FastAPI app on uvloop + httptools (installed by uvicorn[standard], POSIX only)
+    uvicorn.run("app:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop", http="httptools", reload=False)
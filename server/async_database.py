@@ -0,0 +1,322 @@
+# Async database operations for the API endpoints
+# Same SQLite file and queries as database.py, but through aiosqlite so the
+# endpoints can await the database instead of tying up a worker thread.
+# Tables and default data are still created by the sync Database.init_database().
+import aiosqlite
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from database import (
+    rows_to_dicts, MAX_BOUND_PARAMS, ADJUST_BALANCE_SQL, USER_EXISTS_SQL,
+    POSITION_QUANTITY_SQL, UPSERT_POSITION_SQL, DELETE_EMPTY_POSITION_SQL, INSERT_TRANSACTION_SQL,
+)
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator
+
+class AsyncDatabase:
+    def __init__(self, db_path: str = None, readers: int = None):
+        # Same setting as the sync Database so both point at the same file
+        self.db_path = db_path or os.getenv('DATABASE_URL', './trading.db')
+        # Connections are opened on first use and kept for the life of the worker:
+        # one writer (SQLite only allows one at a time anyway) and up to N readers,
+        # which WAL lets run alongside the writer
+        self._writer_conn: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._max_readers = readers or int(os.getenv('DB_READERS', '4'))
+        self._read_slots = asyncio.Semaphore(self._max_readers)
+        self._idle_readers: List[aiosqlite.Connection] = []
+        self._all_readers: List[aiosqlite.Connection] = []
+        # Resources by symbol for trades, so a trade doesn't query the table for its price.
+        # Reloaded when PRAGMA data_version on the writer shows another connection (another
+        # worker) has committed since; this worker's own price ticks patch it directly
+        self._resource_cache: Optional[Dict[str, Dict[str, Any]]] = None
+        self._resource_cache_version: Optional[int] = None
+    
+    async def _connect(self) -> aiosqlite.Connection:
+        """Open a database connection with the same settings as the sync Database"""
+        # Autocommit mode, writes use BEGIN/COMMIT themselves
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None, cached_statements=256)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute('PRAGMA synchronous=NORMAL')
+        await conn.execute('PRAGMA temp_store=MEMORY')
+        await conn.execute('PRAGMA mmap_size=268435456')
+        await conn.execute('PRAGMA cache_size=-65536')
+        await conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+    
+    async def _open_reader(self):
+        """Open one more reader and put it in the idle pool"""
+        conn = await self._connect()
+        self._all_readers.append(conn)
+        self._idle_readers.append(conn)
+    
+    async def _open_writer(self):
+        """Open the writer connection if nobody else has by now"""
+        conn = await self._connect()
+        if self._writer_conn is None:
+            self._writer_conn = conn
+        else:
+            await conn.close()
+    
+    @asynccontextmanager
+    async def _reader(self):
+        """Borrow a reader connection, waiting if all N are busy"""
+        async with self._read_slots:
+            if not self._idle_readers:
+                # Shielded so a cancelled request can't leave an opened connection
+                # outside the pool, where close() would never see it
+                await asyncio.shield(self._open_reader())
+            conn = self._idle_readers.pop()
+            try:
+                yield conn
+            finally:
+                self._idle_readers.append(conn)
+    
+    @asynccontextmanager
+    async def _writer(self):
+        """Get the writer connection, one caller at a time"""
+        async with self._write_lock:
+            if self._writer_conn is None:
+                await asyncio.shield(self._open_writer())
+            yield self._writer_conn
+    
+    @asynccontextmanager
+    async def _transaction(self):
+        """Run a group of writes in one BEGIN IMMEDIATE ... COMMIT on the writer, rolling back on error"""
+        async with self._writer() as conn:
+            try:
+                await conn.execute('BEGIN IMMEDIATE')
+                yield conn
+                await conn.execute('COMMIT')
+            except BaseException:
+                # The writer lives as long as the worker, so it must never be left inside
+                # BEGIN. A cancelled BEGIN may still run on aiosqlite's thread; rollback()
+                # is queued behind it, does nothing if no transaction is open, and is
+                # shielded so a second cancel can't skip it
+                await asyncio.shield(conn.rollback())
+                raise
+    
+    async def close(self):
+        """Close all open connections (called on app shutdown)"""
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._idle_readers.clear()
+        if self._writer_conn is not None:
+            await self._writer_conn.close()
+            self._writer_conn = None
+    
+    # User operations
+    async def create_user(self, username: str, email: str, password_hash: str) -> int:
+        """Create a new user and return user ID"""
+        async with self._writer() as conn:
+            try:
+                cursor = await conn.execute(
+                    'INSERT INTO users (username, email, hashed_password, balance) VALUES (?, ?, ?, ?)',
+                    (username, email, password_hash, 10000.0)
+                )
+                return cursor.lastrowid
+            except aiosqlite.IntegrityError:
+                raise ValueError("User with this username or email already exists")
+    
+    async def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        """Get user by username"""
+        async with self._reader() as conn:
+            cursor = await conn.execute(
+                'SELECT id, username, email, hashed_password, balance, created_at FROM users WHERE username = ?',
+                (username,)
+            )
+            user = await cursor.fetchone()
+            return dict(user) if user else None
+    
+    async def get_user_by_id(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Get user by ID"""
+        async with self._reader() as conn:
+            cursor = await conn.execute(
+                'SELECT id, username, email, balance, created_at FROM users WHERE id = ?',
+                (user_id,)
+            )
+            user = await cursor.fetchone()
+            return dict(user) if user else None
+    
+    async def update_user_password(self, user_id: int, password_hash: str):
+        """Update user's password hash"""
+        async with self._writer() as conn:
+            await conn.execute(
+                'UPDATE users SET hashed_password = ? WHERE id = ?',
+                (password_hash, user_id)
+            )
+    
+    # Resource operations
+    async def get_all_resources(self) -> List[Dict[str, Any]]:
+        """Get all resources"""
+        async with self._reader() as conn:
+            cursor = await conn.execute('SELECT id, symbol, name, current_price, volatility, last_updated FROM resources')
+            cursor.row_factory = None  # plain tuples, no sqlite3.Row per row
+            resources = await cursor.fetchall()
+            return rows_to_dicts(cursor, resources)
+    
+    async def update_resource_prices_bulk(self, updates: List[Tuple[int, float]]):
+        """Update many resource prices in one transaction, updates are (resource_id, new_price)"""
+        max_rows = MAX_BOUND_PARAMS // 2
+        updated = []
+        
+        async with self._transaction() as conn:
+            for start in range(0, len(updates), max_rows):
+                chunk = updates[start:start + max_rows]
+                # One UPDATE ... FROM (VALUES ...) per chunk, returning what was actually stored
+                cursor = await conn.execute(
+                    "UPDATE resources SET current_price = v.column2, last_updated = CAST(strftime('%s', 'now') AS INTEGER) "
+                    "FROM (VALUES " + ', '.join(['(?, ?)'] * len(chunk)) + ") AS v WHERE resources.id = v.column1 "
+                    "RETURNING resources.id AS id, resources.current_price AS current_price, resources.last_updated AS last_updated",
+                    [value for update in chunk for value in update]
+                )
+                updated.extend(await cursor.fetchall())
+        
+        # Committed, so bring the cached prices in line with the stored rows
+        if self._resource_cache is not None:
+            cached_by_id = {resource['id']: resource for resource in self._resource_cache.values()}
+            for row in updated:
+                resource = cached_by_id.get(row['id'])
+                if resource is not None:
+                    resource['current_price'] = float(row['current_price'])
+                    resource['last_updated'] = row['last_updated']
+    
+    async def _cached_resource(self, conn: aiosqlite.Connection, symbol: str) -> Optional[Dict[str, Any]]:
+        """Get a resource by symbol from the cache, using the writer connection the caller holds"""
+        # data_version only moves when another connection commits; the writer's own
+        # trades and price ticks leave it alone
+        cursor = await conn.execute('PRAGMA data_version')
+        version = (await cursor.fetchone())[0]
+        if self._resource_cache is None or version != self._resource_cache_version:
+            cursor = await conn.execute('SELECT id, symbol, current_price, last_updated FROM resources')
+            self._resource_cache = {row['symbol']: dict(row) for row in await cursor.fetchall()}
+            self._resource_cache_version = version
+        return self._resource_cache.get(symbol)
+    
+    # Position operations
+    async def get_user_positions(self, user_id: int) -> List[Dict[str, Any]]:
+        """Get all positions for a user, with current value and profit/loss worked out in SQL"""
+        async with self._reader() as conn:
+            cursor = await conn.execute('''
+                SELECT
+                    p.id,
+                    p.user_id,
+                    p.resource_id,
+                    p.quantity,
+                    p.average_price,
+                    p.created_at,
+                    r.symbol,
+                    r.name,
+                    r.current_price,
+                    p.quantity * r.current_price AS current_value,
+                    p.quantity * (r.current_price - p.average_price) AS profit_loss
+                FROM positions p
+                INNER JOIN resources r ON p.resource_id = r.id
+                WHERE p.user_id = ?
+            ''', (user_id,))
+            cursor.row_factory = None  # plain tuples, no sqlite3.Row per row
+            positions = await cursor.fetchall()
+            return rows_to_dicts(cursor, positions)
+    
+    async def _apply_position_change(self, conn: aiosqlite.Connection, user_id: int, resource_id: int,
+                                     quantity: float, average_price: float):
+        """Add quantity (negative for a sell) to a position using the caller's connection"""
+        await conn.execute(UPSERT_POSITION_SQL, (user_id, resource_id, quantity, average_price))
+        
+        # Delete position if quantity is 0 or negative
+        await conn.execute(DELETE_EMPTY_POSITION_SQL, (user_id, resource_id))
+    
+    async def _adjust_balance(self, conn: aiosqlite.Connection, user_id: int, delta: float) -> float:
+        """Change a balance in one statement using the caller's connection, never letting it go below zero"""
+        cursor = await conn.execute(ADJUST_BALANCE_SQL, (delta, user_id, delta))
+        updated = await cursor.fetchone()
+        if updated:
+            return float(updated['balance'])
+        
+        # Nothing updated - either the user doesn't exist or the balance is too low
+        cursor = await conn.execute(USER_EXISTS_SQL, (user_id,))
+        if not await cursor.fetchone():
+            raise LookupError("User not found")
+        raise ValueError("Insufficient balance")
+    
+    # Trade operations
+    async def execute_trade_atomic(self, user_id: int, symbol: str, trade_type: str, quantity: float) -> tuple:
+        """Run a whole buy/sell in one transaction and return (transaction_id, new_balance)"""
+        # Take the write lock up front so nobody can change the balance/position between check and update
+        async with self._transaction() as conn:
+            resource = await self._cached_resource(conn, symbol)
+            if not resource:
+                raise LookupError("Resource not found")
+            
+            price = resource['current_price']
+            total_value = quantity * price
+            
+            if trade_type == 'buy':
+                # Balance check and update in one statement
+                new_balance = await self._adjust_balance(conn, user_id, -total_value)
+                position_change = quantity
+            else:
+                cursor = await conn.execute(POSITION_QUANTITY_SQL, (user_id, resource['id']))
+                position = await cursor.fetchone()
+                if not position or position['quantity'] < quantity:
+                    raise ValueError("Insufficient quantity to sell")
+                
+                new_balance = await self._adjust_balance(conn, user_id, total_value)
+                position_change = -quantity
+            
+            await self._apply_position_change(conn, user_id, resource['id'], position_change, price)
+            
+            cursor = await conn.execute(
+                INSERT_TRANSACTION_SQL, (user_id, resource['id'], trade_type, quantity, price, total_value)
+            )
+            return cursor.lastrowid, new_balance
+    
+    # Transaction operations
+    async def get_user_transactions(self, user_id: int, limit: int = 100, before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get a page of a user's transactions, newest first (pass before_id to get older ones)"""
+        async with self._reader() as conn:
+            cursor = await conn.execute('''
+                SELECT
+                    t.id,
+                    t.user_id,
+                    t.resource_id,
+                    t.transaction_type,
+                    t.quantity,
+                    t.price,
+                    t.total_value,
+                    t.timestamp,
+                    r.symbol,
+                    r.name
+                FROM transactions t
+                INNER JOIN resources r ON t.resource_id = r.id
+                WHERE t.user_id = ? AND (? IS NULL OR t.id < ?)
+                ORDER BY t.id DESC
+                LIMIT ?
+            ''', (user_id, before_id, before_id, limit))
+            cursor.row_factory = None  # plain tuples, no sqlite3.Row per row
+            
+            # Read in batches instead of fetchall() to keep peak memory down
+            transactions = []
+            while True:
+                batch = await cursor.fetchmany(512)
+                if not batch:
+                    break
+                transactions.extend(rows_to_dicts(cursor, batch))
+            return transactions
+    
+    async def iter_user_transactions(self, user_id: int, page_size: int = 500) -> AsyncIterator[Dict[str, Any]]:
+        """Yield a user's whole transaction history, newest first, one page in memory at a time"""
+        # Each page borrows a reader only while it is fetched, so a slow client
+        # streaming a long history doesn't hold one of the N readers the whole time
+        before_id = None
+        while True:
+            transactions = await self.get_user_transactions(user_id, limit=page_size, before_id=before_id)
+            for transaction in transactions:
+                yield transaction
+            if len(transactions) < page_size:
+                return
+            before_id = transactions[-1]['id']
+
+
+# Global async database instance used by the API endpoints
+async_db = AsyncDatabase()
@@ -1,7 +1,13 @@
 # Authentication utilities for the Trading Platform
-# This matches the same pattern as keep-in-touch-chat
+# Argon2id password hashing (bcrypt only to verify old hashes) and JWT tokens
 import bcrypt
+import hashlib
+import threading
+import time
 import jwt
+from cachetools import TTLCache, TLRUCache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 import os
 from datetime import datetime, timedelta
 from functools import wraps
@@ -11,16 +17,52 @@ from typing import Optional
 # JWT secret from environment
 JWT_SECRET = os.getenv('JWT_SECRET', 'your-super-secret-jwt-key-here')
 
+# Argon2id cost policy (defaults: t=3, m=64MiB, p=1)
+# Raising these makes needs_rehash() upgrade stored hashes on the next login
+ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', 3))
+ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', 65536))
+ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', 1))
+
+_ph = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=ARGON2_PARALLELISM)
+
+def is_legacy_hash(hashed: str) -> bool:
+    """Check if a hash was made by the old bcrypt scheme"""
+    return hashed.startswith('$2')
+
 def hash_password(password: str) -> str:
-    """Hash a password using bcrypt"""
-    # Generate salt and hash password
-    salt = bcrypt.gensalt(rounds=10)
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
-    return hashed.decode('utf-8')
+    """Hash a password using Argon2id"""
+    return _ph.hash(password)
+
+# Recent verify results so repeat logins skip the slow hash (per process, never logged)
+_verify_cache = TTLCache(maxsize=4096, ttl=60)
+_verify_cache_lock = threading.Lock()
 
 def verify_password(password: str, hashed: str) -> bool:
-    """Verify a password against its hash"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    """Verify a password against its hash, reusing recent results"""
+    key = hashlib.sha256(password.encode('utf-8') + b'|' + hashed.encode('utf-8')).digest()
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    result = _verify_password_uncached(password, hashed)
+    with _verify_cache_lock:
+        _verify_cache[key] = result
+    return result
+
+def _verify_password_uncached(password: str, hashed: str) -> bool:
+    """Run the actual bcrypt/Argon2 check"""
+    # Older accounts still have bcrypt hashes until they log in again
+    if is_legacy_hash(hashed):
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    try:
+        return _ph.verify(hashed, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def needs_rehash(hashed: str) -> bool:
+    """Check if a stored hash should be upgraded to the current Argon2id settings"""
+    return is_legacy_hash(hashed) or _ph.check_needs_rehash(hashed)
 
 def generate_token(user_id: int, username: str) -> str:
     """Generate a JWT token for a user"""
@@ -31,10 +73,25 @@ def generate_token(user_id: int, username: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
 
+# Decoded token payloads, kept for up to 5 minutes and never past the token's own expiry
+_token_cache = TLRUCache(
+    maxsize=10000,
+    ttu=lambda token, payload, now: min(now + 300, payload.get('exp', now + 300)),
+    timer=time.time,
+)
+_token_cache_lock = threading.Lock()
+
 def verify_token(token: str) -> dict:
     """Verify and decode a JWT token"""
+    with _token_cache_lock:
+        payload = _token_cache.get(token)
+    if payload is not None:
+        return payload
+    
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+        with _token_cache_lock:
+            _token_cache[token] = payload
         return payload
     except jwt.ExpiredSignatureError:
         raise ValueError('Token has expired')
@@ -4,90 +4,224 @@
 # This matches the same pattern as keep-in-touch-chat
 import sqlite3
 import os
-from datetime import datetime
-from typing import Optional, List, Dict, Any
+import atexit
+import threading
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Tuple, Iterator
+from auth import get_password_hash
+
+def rows_to_dicts(cursor, rows) -> List[Dict[str, Any]]:
+    """Turn plain tuple rows into dicts, looking the column names up only once"""
+    keys = [column[0] for column in cursor.description]
+    return [dict(zip(keys, row)) for row in rows]
+
+# Statements of a trade, shared with async_database.py so both layers trade the same way
+# (the async layer looks the resource up in its cache instead of with this query)
+RESOURCE_PRICE_BY_SYMBOL_SQL = 'SELECT id, current_price FROM resources WHERE symbol = ?'
+
+# Change a balance in one statement, never letting it go below zero
+ADJUST_BALANCE_SQL = 'UPDATE users SET balance = balance + ? WHERE id = ? AND balance + ? >= 0 RETURNING balance'
+USER_EXISTS_SQL = 'SELECT id FROM users WHERE id = ?'
+
+POSITION_QUANTITY_SQL = 'SELECT quantity FROM positions WHERE user_id = ? AND resource_id = ?'
+
+# Insert the position, or add to it and recalculate the average price, in one statement
+UPSERT_POSITION_SQL = '''
+    INSERT INTO positions (user_id, resource_id, quantity, average_price)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, resource_id) DO UPDATE SET
+        average_price = CASE
+            WHEN quantity + excluded.quantity > 0
+            THEN (quantity * average_price + excluded.quantity * excluded.average_price) / (quantity + excluded.quantity)
+            ELSE average_price
+        END,
+        quantity = quantity + excluded.quantity
+'''
+DELETE_EMPTY_POSITION_SQL = 'DELETE FROM positions WHERE user_id = ? AND resource_id = ? AND quantity <= 0'
+
+INSERT_TRANSACTION_SQL = 'INSERT INTO transactions (user_id, resource_id, transaction_type, quantity, price, total_value) VALUES (?, ?, ?, ?, ?, ?)'
+
+# Most parameters bound to one statement. SQLite allows at most 999 in older
+# builds, so stay well under it
+MAX_BOUND_PARAMS = 500
+
+# Timestamp column of each table, converted from text by _migrate_text_timestamps()
+_TIMESTAMP_COLUMNS = {
+    'users': 'created_at',
+    'resources': 'last_updated',
+    'positions': 'created_at',
+    'transactions': 'timestamp',
+}
+
+# CREATE TABLE statement of each table. _migrate_text_timestamps() also builds
+# the replacement tables from these. Timestamps are unix seconds.
+_TABLE_SQL = {
+    # Users table - stores user account information
+    'users': '''CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    hashed_password TEXT NOT NULL,
+    balance REAL DEFAULT 10000.0,
+    created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+)''',
+    
+    # Resources table - stores tradeable assets
+    'resources': '''CREATE TABLE IF NOT EXISTS resources (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    symbol TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    current_price REAL NOT NULL,
+    volatility REAL DEFAULT 0.02,
+    last_updated INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+)''',
+    
+    # Positions table - stores what users currently own
+    'positions': '''CREATE TABLE IF NOT EXISTS positions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    resource_id INTEGER NOT NULL,
+    quantity REAL NOT NULL,
+    average_price REAL NOT NULL,
+    created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+    FOREIGN KEY (user_id) REFERENCES users (id),
+    FOREIGN KEY (resource_id) REFERENCES resources (id),
+    UNIQUE(user_id, resource_id)
+)''',
+    
+    # Transactions table - stores all buy/sell history
+    'transactions': '''CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    resource_id INTEGER NOT NULL,
+    transaction_type TEXT NOT NULL,
+    quantity REAL NOT NULL,
+    price REAL NOT NULL,
+    total_value REAL NOT NULL,
+    timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+    FOREIGN KEY (user_id) REFERENCES users (id),
+    FOREIGN KEY (resource_id) REFERENCES resources (id)
+)''',
+}
+
+# Indexes for the per-user lookups and joins (positions already has one from
+# UNIQUE(user_id, resource_id), which also covers user_id alone)
+_INDEX_SQL = [
+    'CREATE INDEX IF NOT EXISTS idx_tx_user_id ON transactions (user_id, id DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_tx_resource ON transactions (resource_id)',
+]
+
+# The whole schema, run by init_database() in one executescript() call
+_SCHEMA_SQL = 'BEGIN;\n' + ';\n'.join([*_TABLE_SQL.values(), *_INDEX_SQL]) + ';\nCOMMIT;\n'
 
 class Database:
     def __init__(self, db_path: str = None):
         # Use environment variable or default path
         # This lets us configure where the database file goes
         self.db_path = db_path or os.getenv('DATABASE_URL', './trading.db')
-        self.init_database()  # Create tables when we start up
+        # Each thread keeps one open connection instead of reconnecting for every query.
+        # They are also tracked here by thread, so connections of finished threads can be
+        # closed and close() can reach all of them
+        self._local = threading.local()
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._connections_lock = threading.Lock()
+        atexit.register(self.close)
+        # Tables are created by init_database(), which the app calls at startup,
+        # so just importing this module doesn't touch the database
     
     def get_connection(self):
-        """Get a database connection"""
+        """Get this thread's database connection, opening it the first time"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        
         # Connect to the SQLite database file
-        conn = sqlite3.connect(self.db_path)
+        # isolation_level=None means autocommit; writes use BEGIN IMMEDIATE/COMMIT via transaction()
+        # sqlite3 keeps compiled statements per connection keyed by SQL text; since the connection
+        # now lives as long as the thread, a bigger cache means our queries are only parsed once
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
         # This makes it so we can access columns by name instead of just numbers
         conn.row_factory = sqlite3.Row
+        # Per-connection settings: fewer fsyncs (safe with WAL), temp tables in memory,
+        # memory-mapped reads, a 64MB page cache and enforced foreign keys
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA cache_size=-65536')
+        conn.execute('PRAGMA foreign_keys=ON')
+        
+        self._local.conn = conn
+        with self._connections_lock:
+            # Close connections left behind by threads that have exited since
+            for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                self._connections.pop(thread).close()
+            self._connections[threading.current_thread()] = conn
         return conn
     
+    def close(self):
+        """Close every thread's connection; a thread that uses the database again opens a new one"""
+        with self._connections_lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+            self._local = threading.local()
+    
+    def tuple_cursor(self):
+        """Get a cursor that returns plain tuples instead of sqlite3.Row, for list queries"""
+        cursor = self.get_connection().cursor()
+        cursor.row_factory = None
+        return cursor
+    
+    @contextmanager
+    def transaction(self):
+        """Run a group of writes in one BEGIN IMMEDIATE ... COMMIT, rolling back on error"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+    
+    def _select_by_ids(self, sql: str, ids: List[int]) -> List[Dict[str, Any]]:
+        """Run a query containing IN ({placeholders}) for a list of IDs, MAX_BOUND_PARAMS at a time"""
+        max_ids = MAX_BOUND_PARAMS
+        ids = list(dict.fromkeys(ids))
+        cursor = self.tuple_cursor()
+        results = []
+        
+        for start in range(0, len(ids), max_ids):
+            chunk = ids[start:start + max_ids]
+            cursor.execute(sql.format(placeholders=', '.join(['?'] * len(chunk))), chunk)
+            results.extend(rows_to_dicts(cursor, cursor.fetchall()))
+        
+        return results
+    
     def init_database(self):
         """Initialize database tables"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            cursor = self.get_connection().cursor()
         except Exception as e:
             print(f"Error connecting to database: {e}")
             raise
         
         try:
-            # Users table - stores user account information
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    hashed_password TEXT NOT NULL,
-                    balance REAL DEFAULT 10000.0,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            # WAL lets readers and the writer work at the same time. It's stored in the
+            # database file so it only needs setting once (not possible for in-memory databases).
+            # It can't be changed inside a transaction, so it goes before the schema's BEGIN
+            script = _SCHEMA_SQL
+            if self.db_path != ':memory:':
+                script = 'PRAGMA journal_mode=WAL;\n' + script
             
-            # Resources table - stores tradeable assets
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS resources (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    symbol TEXT UNIQUE NOT NULL,
-                    name TEXT NOT NULL,
-                    current_price REAL NOT NULL,
-                    volatility REAL DEFAULT 0.02,
-                    last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Positions table - stores what users currently own
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS positions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    resource_id INTEGER NOT NULL,
-                    quantity REAL NOT NULL,
-                    average_price REAL NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id),
-                    FOREIGN KEY (resource_id) REFERENCES resources (id),
-                    UNIQUE(user_id, resource_id)
-                )
-            ''')
+            # All tables and indexes in one script, one parse and one transaction
+            cursor.executescript(script)
             
-            # Transactions table - stores all buy/sell history
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    resource_id INTEGER NOT NULL,
-                    transaction_type TEXT NOT NULL,
-                    quantity REAL NOT NULL,
-                    price REAL NOT NULL,
-                    total_value REAL NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id),
-                    FOREIGN KEY (resource_id) REFERENCES resources (id)
-                )
-            ''')
+            # Databases made before timestamps became unix seconds still have text columns
+            self._migrate_text_timestamps()
             
-            conn.commit()
             print("Database tables initialized successfully")
             
             # Create default resources if they don't exist
@@ -97,16 +231,59 @@ class Database:
             self.create_test_user()
             
         except Exception as e:
+            # Don't leave the schema script's transaction open on this thread's connection
+            if cursor.connection.in_transaction:
+                cursor.execute('ROLLBACK')
             print(f"Error initializing database: {e}")
-            conn.rollback()
+    
+    def _migrate_text_timestamps(self):
+        """Rebuild tables that still have text CURRENT_TIMESTAMP columns so they hold unix seconds"""
+        conn = self.get_connection()
+        
+        def legacy_tables(cursor) -> List[Tuple[str, str]]:
+            return [
+                (table, column) for table, column in _TIMESTAMP_COLUMNS.items()
+                if cursor.execute(f"SELECT type FROM pragma_table_info('{table}') WHERE name = ?", (column,)).fetchone()[0] != 'INTEGER'
+            ]
+        
+        # Cheap check without the write lock, nothing to do on every start after the first
+        if not legacy_tables(conn):
+            return
+        
+        # SQLite can't change a column's type or default in place, so each table is copied
+        # into a new one made from _TABLE_SQL. Foreign keys have to be off to drop the old
+        # tables (and the pragma does nothing inside a transaction)
+        conn.execute('PRAGMA foreign_keys=OFF')
+        try:
+            with self.transaction() as cursor:
+                # Look again now that we hold the write lock, another process may have
+                # migrated some or all of the tables while we waited for it
+                legacy = legacy_tables(cursor)
+                for table, column in legacy:
+                    cursor.execute(_TABLE_SQL[table].replace(f'IF NOT EXISTS {table} (', f'{table}_new (', 1))
+                    
+                    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+                    # Rows written since the switch may already be integers, leave those alone
+                    values = [
+                        f"CASE WHEN typeof({name}) = 'text' THEN CAST(strftime('%s', {name}) AS INTEGER) ELSE {name} END"
+                        if name == column else name
+                        for name in columns
+                    ]
+                    cursor.execute(f'INSERT INTO {table}_new ({", ".join(columns)}) SELECT {", ".join(values)} FROM {table}')
+                    cursor.execute(f'DROP TABLE {table}')
+                    cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+                
+                # Dropping the old tables dropped their indexes too
+                for index_sql in _INDEX_SQL:
+                    cursor.execute(index_sql)
         finally:
-            conn.close()
+            conn.execute('PRAGMA foreign_keys=ON')
+        
+        if legacy:
+            print(f"  Converted timestamps to unix seconds in: {', '.join(table for table, _ in legacy)}")
     
     def create_default_resources(self):
         """Create default resources if they don't exist"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         try:
             default_resources = [
                 {"symbol": "ENG", "name": "Energy Units", "price": 100.0, "volatility": 0.03},
@@ -116,295 +293,373 @@ class Database:
                 {"symbol": "MET", "name": "Rare Metals", "price": 150.0, "volatility": 0.025},
             ]
             
-            for resource_data in default_resources:
-                cursor.execute('SELECT id FROM resources WHERE symbol = ?', (resource_data["symbol"],))
-                existing = cursor.fetchone()
-                
-                if not existing:
-                    cursor.execute(
-                        'INSERT INTO resources (symbol, name, current_price, volatility, last_updated) VALUES (?, ?, ?, ?, ?)',
-                        (resource_data["symbol"], resource_data["name"], resource_data["price"], 
-                         resource_data["volatility"], datetime.utcnow())
-                    )
-                    print(f"  Added: {resource_data['name']} ({resource_data['symbol']})")
+            # One INSERT OR IGNORE batch in one transaction; the UNIQUE symbol skips existing rows
+            # (last_updated is filled in by its column default)
+            with self.transaction() as cursor:
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO resources (symbol, name, current_price, volatility) VALUES (?, ?, ?, ?)',
+                    [(r["symbol"], r["name"], r["price"], r["volatility"]) for r in default_resources]
+                )
+                added = cursor.rowcount
             
-            conn.commit()
+            if added > 0:
+                print(f"  Added {added} default resources")
         except Exception as e:
             print(f"Error creating default resources: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
     
     def create_test_user(self):
-        """Create test user if it doesn't exist"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Create test user if it doesn't exist (only when CREATE_TEST_USER is set)"""
+        # Dev-only account, and hashing its password isn't free, so skip it unless asked for
+        if not os.getenv('CREATE_TEST_USER'):
+            return
         
         try:
-            from auth import get_password_hash
-            
+            cursor = self.get_connection().cursor()
             cursor.execute('SELECT id FROM users WHERE username = ?', ('testuser',))
             existing = cursor.fetchone()
             
             if not existing:
                 password_hash = get_password_hash("password123")
-                cursor.execute(
-                    'INSERT INTO users (username, email, hashed_password, balance) VALUES (?, ?, ?, ?)',
-                    ('testuser', 'test@example.com', password_hash, 10000.0)
-                )
-                conn.commit()
+                with self.transaction() as cursor:
+                    cursor.execute(
+                        'INSERT INTO users (username, email, hashed_password, balance) VALUES (?, ?, ?, ?)',
+                        ('testuser', 'test@example.com', password_hash, 10000.0)
+                    )
                 print("Added test user: testuser / password123")
         except Exception as e:
             print(f"Error creating test user: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
     
     # User operations
     def create_user(self, username: str, email: str, password_hash: str) -> int:
         """Create a new user and return user ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute(
-                'INSERT INTO users (username, email, hashed_password, balance) VALUES (?, ?, ?, ?)',
-                (username, email, password_hash, 10000.0)
-            )
-            user_id = cursor.lastrowid
-            conn.commit()
-            return user_id
+            with self.transaction() as cursor:
+                cursor.execute(
+                    'INSERT INTO users (username, email, hashed_password, balance) VALUES (?, ?, ?, ?)',
+                    (username, email, password_hash, 10000.0)
+                )
+                return cursor.lastrowid
         except sqlite3.IntegrityError:
             raise ValueError("User with this username or email already exists")
-        finally:
-            conn.close()
     
     def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
         """Get user by username"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         
-        try:
-            cursor.execute(
-                'SELECT id, username, email, hashed_password, balance, created_at FROM users WHERE username = ?',
-                (username,)
-            )
-            user = cursor.fetchone()
-            return dict(user) if user else None
-        finally:
-            conn.close()
+        cursor.execute(
+            'SELECT id, username, email, hashed_password, balance, created_at FROM users WHERE username = ?',
+            (username,)
+        )
+        user = cursor.fetchone()
+        return dict(user) if user else None
     
     def get_user_by_id(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         
-        try:
-            cursor.execute(
-                'SELECT id, username, email, balance, created_at FROM users WHERE id = ?',
-                (user_id,)
-            )
-            user = cursor.fetchone()
-            return dict(user) if user else None
-        finally:
-            conn.close()
+        cursor.execute(
+            'SELECT id, username, email, balance, created_at FROM users WHERE id = ?',
+            (user_id,)
+        )
+        user = cursor.fetchone()
+        return dict(user) if user else None
+    
+    def get_users_by_ids(self, user_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Get many users in one query, keyed by ID (missing IDs are left out)"""
+        users = self._select_by_ids(
+            'SELECT id, username, email, balance, created_at FROM users WHERE id IN ({placeholders})',
+            user_ids
+        )
+        return {user['id']: user for user in users}
     
     def update_user_balance(self, user_id: int, new_balance: float):
-        """Update user's balance"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
+        """Update user's balance (deprecated for trades: use execute_trade)"""
+        with self.transaction() as cursor:
             cursor.execute(
                 'UPDATE users SET balance = ? WHERE id = ?',
                 (new_balance, user_id)
             )
-            conn.commit()
-        finally:
-            conn.close()
+    
+    def adjust_user_balance(self, user_id: int, delta: float) -> float:
+        """Add delta (negative to take money out) to a user's balance and return the new balance"""
+        with self.transaction() as cursor:
+            return self._adjust_balance(cursor, user_id, delta)
+    
+    def _adjust_balance(self, cursor, user_id: int, delta: float) -> float:
+        """Change a balance in one statement using the caller's cursor, never letting it go below zero"""
+        cursor.execute(ADJUST_BALANCE_SQL, (delta, user_id, delta))
+        updated = cursor.fetchone()
+        if updated:
+            return float(updated['balance'])
+        
+        # Nothing updated - either the user doesn't exist or the balance is too low
+        cursor.execute(USER_EXISTS_SQL, (user_id,))
+        if not cursor.fetchone():
+            raise LookupError("User not found")
+        raise ValueError("Insufficient balance")
+    
+    def update_user_password(self, user_id: int, password_hash: str):
+        """Update user's password hash"""
+        with self.transaction() as cursor:
+            cursor.execute(
+                'UPDATE users SET hashed_password = ? WHERE id = ?',
+                (password_hash, user_id)
+            )
     
     # Resource operations
     def get_all_resources(self) -> List[Dict[str, Any]]:
         """Get all resources"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.tuple_cursor()
         
-        try:
-            cursor.execute('SELECT id, symbol, name, current_price, volatility, last_updated FROM resources')
-            resources = cursor.fetchall()
-            return [dict(resource) for resource in resources]
-        finally:
-            conn.close()
+        cursor.execute('SELECT id, symbol, name, current_price, volatility, last_updated FROM resources')
+        resources = cursor.fetchall()
+        return rows_to_dicts(cursor, resources)
     
     def get_resource_by_symbol(self, symbol: str) -> Optional[Dict[str, Any]]:
         """Get resource by symbol"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         
-        try:
-            cursor.execute(
-                'SELECT id, symbol, name, current_price, volatility, last_updated FROM resources WHERE symbol = ?',
-                (symbol,)
-            )
-            resource = cursor.fetchone()
-            return dict(resource) if resource else None
-        finally:
-            conn.close()
+        cursor.execute(
+            'SELECT id, symbol, name, current_price, volatility, last_updated FROM resources WHERE symbol = ?',
+            (symbol,)
+        )
+        resource = cursor.fetchone()
+        return dict(resource) if resource else None
+    
+    def get_resources_by_ids(self, resource_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Get many resources in one query, keyed by ID (missing IDs are left out)"""
+        resources = self._select_by_ids(
+            'SELECT id, symbol, name, current_price, volatility, last_updated FROM resources WHERE id IN ({placeholders})',
+            resource_ids
+        )
+        return {resource['id']: resource for resource in resources}
     
     def update_resource_price(self, resource_id: int, new_price: float):
         """Update resource price"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
+        with self.transaction() as cursor:
             cursor.execute(
-                'UPDATE resources SET current_price = ?, last_updated = ? WHERE id = ?',
-                (new_price, datetime.utcnow(), resource_id)
+                "UPDATE resources SET current_price = ?, last_updated = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = ?",
+                (new_price, resource_id)
+            )
+    
+    def update_resource_prices_bulk(self, updates: List[Tuple[int, float]]):
+        """Update many resource prices in one transaction, updates are (resource_id, new_price)"""
+        with self.transaction() as cursor:
+            cursor.executemany(
+                "UPDATE resources SET current_price = ?2, last_updated = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = ?1",
+                updates
             )
-            conn.commit()
-        finally:
-            conn.close()
     
     # Position operations
     def get_user_positions(self, user_id: int) -> List[Dict[str, Any]]:
-        """Get all positions for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Get all positions for a user, with current value and profit/loss worked out in SQL"""
+        cursor = self.tuple_cursor()
         
-        try:
-            cursor.execute('''
-                SELECT 
-                    p.id,
-                    p.user_id,
-                    p.resource_id,
-                    p.quantity,
-                    p.average_price,
-                    p.created_at,
-                    r.symbol,
-                    r.name,
-                    r.current_price
-                FROM positions p
-                INNER JOIN resources r ON p.resource_id = r.id
-                WHERE p.user_id = ?
-            ''', (user_id,))
-            positions = cursor.fetchall()
-            return [dict(pos) for pos in positions]
-        finally:
-            conn.close()
+        cursor.execute('''
+            SELECT 
+                p.id,
+                p.user_id,
+                p.resource_id,
+                p.quantity,
+                p.average_price,
+                p.created_at,
+                r.symbol,
+                r.name,
+                r.current_price,
+                p.quantity * r.current_price AS current_value,
+                p.quantity * (r.current_price - p.average_price) AS profit_loss
+            FROM positions p
+            INNER JOIN resources r ON p.resource_id = r.id
+            WHERE p.user_id = ?
+        ''', (user_id,))
+        positions = cursor.fetchall()
+        return rows_to_dicts(cursor, positions)
+    
+    def get_user_position_totals(self, user_id: int) -> Dict[str, float]:
+        """Get the total current value and profit/loss of a user's positions in one row"""
+        cursor = self.get_connection().cursor()
+        
+        cursor.execute('''
+            SELECT 
+                COALESCE(SUM(p.quantity * r.current_price), 0.0) AS current_value,
+                COALESCE(SUM(p.quantity * (r.current_price - p.average_price)), 0.0) AS profit_loss
+            FROM positions p
+            INNER JOIN resources r ON p.resource_id = r.id
+            WHERE p.user_id = ?
+        ''', (user_id,))
+        return dict(cursor.fetchone())
+    
+    def get_positions_bulk(self, user_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+        """Get the positions of many users in one query, keyed by user ID"""
+        positions = self._select_by_ids('''
+            SELECT 
+                p.id,
+                p.user_id,
+                p.resource_id,
+                p.quantity,
+                p.average_price,
+                p.created_at,
+                r.symbol,
+                r.name,
+                r.current_price,
+                p.quantity * r.current_price AS current_value,
+                p.quantity * (r.current_price - p.average_price) AS profit_loss
+            FROM positions p
+            INNER JOIN resources r ON p.resource_id = r.id
+            WHERE p.user_id IN ({placeholders})
+        ''', user_ids)
+        
+        # Every requested user gets an entry, even if they have no positions
+        by_user = {user_id: [] for user_id in user_ids}
+        for position in positions:
+            by_user[position['user_id']].append(position)
+        return by_user
     
     def get_position(self, user_id: int, resource_id: int) -> Optional[Dict[str, Any]]:
         """Get a specific position"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         
-        try:
-            cursor.execute('''
-                SELECT 
-                    p.id,
-                    p.user_id,
-                    p.resource_id,
-                    p.quantity,
-                    p.average_price,
-                    p.created_at,
-                    r.symbol,
-                    r.name,
-                    r.current_price
-                FROM positions p
-                INNER JOIN resources r ON p.resource_id = r.id
-                WHERE p.user_id = ? AND p.resource_id = ?
-            ''', (user_id, resource_id))
-            position = cursor.fetchone()
-            return dict(position) if position else None
-        finally:
-            conn.close()
+        cursor.execute('''
+            SELECT 
+                p.id,
+                p.user_id,
+                p.resource_id,
+                p.quantity,
+                p.average_price,
+                p.created_at,
+                r.symbol,
+                r.name,
+                r.current_price
+            FROM positions p
+            INNER JOIN resources r ON p.resource_id = r.id
+            WHERE p.user_id = ? AND p.resource_id = ?
+        ''', (user_id, resource_id))
+        position = cursor.fetchone()
+        return dict(position) if position else None
     
     def create_or_update_position(self, user_id: int, resource_id: int, quantity: float, average_price: float):
-        """Create or update a position"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Create or update a position (deprecated for trades: use execute_trade)"""
+        with self.transaction() as cursor:
+            self._apply_position_change(cursor, user_id, resource_id, quantity, average_price)
+    
+    def _apply_position_change(self, cursor, user_id: int, resource_id: int, quantity: float, average_price: float):
+        """Add quantity (negative for a sell) to a position using the caller's cursor"""
+        cursor.execute(UPSERT_POSITION_SQL, (user_id, resource_id, quantity, average_price))
         
-        try:
-            # Check if position exists
-            cursor.execute(
-                'SELECT id, quantity FROM positions WHERE user_id = ? AND resource_id = ?',
-                (user_id, resource_id)
-            )
-            existing = cursor.fetchone()
+        # Delete position if quantity is 0 or negative
+        cursor.execute(DELETE_EMPTY_POSITION_SQL, (user_id, resource_id))
+    
+    # Trade operations
+    def execute_trade(self, user_id: int, resource_id: int, txn_type: str, quantity: float, price: float) -> tuple:
+        """Apply a buy/sell at a given price in one transaction and return (transaction_id, new_balance)"""
+        with self.transaction() as cursor:
+            return self._apply_trade(cursor, user_id, resource_id, txn_type, quantity, price)
+    
+    def execute_trade_atomic(self, user_id: int, symbol: str, trade_type: str, quantity: float) -> tuple:
+        """Look up the current price and run a whole buy/sell in one transaction, returning (transaction_id, new_balance)"""
+        # BEGIN IMMEDIATE takes the write lock up front so nobody can change the
+        # price, balance or position between our check and our update
+        with self.transaction() as cursor:
+            cursor.execute(RESOURCE_PRICE_BY_SYMBOL_SQL, (symbol,))
+            resource = cursor.fetchone()
+            if not resource:
+                raise LookupError("Resource not found")
             
-            if existing:
-                # Update existing position
-                new_quantity = existing['quantity'] + quantity
-                if new_quantity <= 0:
-                    # Delete position if quantity is 0 or negative
-                    cursor.execute(
-                        'DELETE FROM positions WHERE user_id = ? AND resource_id = ?',
-                        (user_id, resource_id)
-                    )
-                else:
-                    # Recalculate average price
-                    total_value = (existing['quantity'] * existing['average_price']) + (quantity * average_price)
-                    new_avg_price = total_value / new_quantity
-                    cursor.execute(
-                        'UPDATE positions SET quantity = ?, average_price = ? WHERE user_id = ? AND resource_id = ?',
-                        (new_quantity, new_avg_price, user_id, resource_id)
-                    )
-            else:
-                # Create new position
-                cursor.execute(
-                    'INSERT INTO positions (user_id, resource_id, quantity, average_price) VALUES (?, ?, ?, ?)',
-                    (user_id, resource_id, quantity, average_price)
-                )
+            return self._apply_trade(cursor, user_id, resource['id'], trade_type, quantity, resource['current_price'])
+    
+    def _apply_trade(self, cursor, user_id: int, resource_id: int, trade_type: str, quantity: float, price: float) -> tuple:
+        """Write the balance change, position change and transaction record using the caller's cursor"""
+        total_value = quantity * price
+        
+        if trade_type == 'buy':
+            # Balance check and update in one statement
+            new_balance = self._adjust_balance(cursor, user_id, -total_value)
+            position_change = quantity
+        else:
+            cursor.execute(POSITION_QUANTITY_SQL, (user_id, resource_id))
+            position = cursor.fetchone()
+            if not position or position['quantity'] < quantity:
+                raise ValueError("Insufficient quantity to sell")
             
-            conn.commit()
-        finally:
-            conn.close()
+            new_balance = self._adjust_balance(cursor, user_id, total_value)
+            position_change = -quantity
+        
+        self._apply_position_change(cursor, user_id, resource_id, position_change, price)
+        
+        cursor.execute(INSERT_TRANSACTION_SQL, (user_id, resource_id, trade_type, quantity, price, total_value))
+        return cursor.lastrowid, new_balance
     
     # Transaction operations
     def create_transaction(self, user_id: int, resource_id: int, transaction_type: str, 
                           quantity: float, price: float, total_value: float) -> int:
-        """Create a transaction and return transaction ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Create a transaction and return transaction ID (deprecated for trades: use execute_trade)"""
+        return self.create_transactions_bulk([
+            (user_id, resource_id, transaction_type, quantity, price, total_value)
+        ])[0]
+    
+    def create_transactions_bulk(self, rows: List[tuple]) -> List[int]:
+        """Insert many transactions in one DB transaction and return their IDs"""
+        # Each row is (user_id, resource_id, transaction_type, quantity, price, total_value)
+        max_rows = MAX_BOUND_PARAMS // 6
+        transaction_ids = []
         
-        try:
-            cursor.execute(
-                'INSERT INTO transactions (user_id, resource_id, transaction_type, quantity, price, total_value) VALUES (?, ?, ?, ?, ?, ?)',
-                (user_id, resource_id, transaction_type, quantity, price, total_value)
-            )
-            transaction_id = cursor.lastrowid
-            conn.commit()
-            return transaction_id
-        finally:
-            conn.close()
+        with self.transaction() as cursor:
+            for start in range(0, len(rows), max_rows):
+                chunk = rows[start:start + max_rows]
+                cursor.execute(
+                    'INSERT INTO transactions (user_id, resource_id, transaction_type, quantity, price, total_value) VALUES '
+                    + ', '.join(['(?, ?, ?, ?, ?, ?)'] * len(chunk)),
+                    [value for row in chunk for value in row]
+                )
+                # We hold the write lock, so the IDs of one multi-row INSERT are consecutive
+                last_id = cursor.lastrowid
+                transaction_ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+        
+        return transaction_ids
     
-    def get_user_transactions(self, user_id: int) -> List[Dict[str, Any]]:
-        """Get all transactions for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_user_transactions(self, user_id: int, limit: int = 100, before_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get a page of a user's transactions, newest first (pass before_id to get older ones)"""
+        cursor = self.tuple_cursor()
         
-        try:
-            cursor.execute('''
-                SELECT 
-                    t.id,
-                    t.user_id,
-                    t.resource_id,
-                    t.transaction_type,
-                    t.quantity,
-                    t.price,
-                    t.total_value,
-                    t.timestamp,
-                    r.symbol,
-                    r.name
-                FROM transactions t
-                INNER JOIN resources r ON t.resource_id = r.id
-                WHERE t.user_id = ?
-                ORDER BY t.timestamp DESC
-            ''', (user_id,))
-            transactions = cursor.fetchall()
-            return [dict(txn) for txn in transactions]
-        finally:
-            conn.close()
+        cursor.execute('''
+            SELECT 
+                t.id,
+                t.user_id,
+                t.resource_id,
+                t.transaction_type,
+                t.quantity,
+                t.price,
+                t.total_value,
+                t.timestamp,
+                r.symbol,
+                r.name
+            FROM transactions t
+            INNER JOIN resources r ON t.resource_id = r.id
+            WHERE t.user_id = ? AND (? IS NULL OR t.id < ?)
+            ORDER BY t.id DESC
+            LIMIT ?
+        ''', (user_id, before_id, before_id, limit))
+        # Read in batches instead of fetchall() to keep peak memory down
+        transactions = []
+        while True:
+            batch = cursor.fetchmany(512)
+            if not batch:
+                break
+            transactions.extend(rows_to_dicts(cursor, batch))
+        return transactions
+    
+    def iter_user_transactions(self, user_id: int, page_size: int = 500) -> Iterator[Dict[str, Any]]:
+        """Yield a user's whole transaction history, newest first, one page in memory at a time"""
+        # Keyset pages rather than one long-running cursor, so no read stays open
+        # between pages while the caller is busy with the rows
+        before_id = None
+        while True:
+            transactions = self.get_user_transactions(user_id, limit=page_size, before_id=before_id)
+            yield from transactions
+            if len(transactions) < page_size:
+                return
+            before_id = transactions[-1]['id']
 
 
-# Global database instance - initializes automatically when imported (like keep-in-touch-chat)
+# Global database instance (tables are created when the app calls db.init_database())
 db = Database()
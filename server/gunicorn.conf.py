@@ -0,0 +1,13 @@
+# Gunicorn settings for production (used by the Procfile and render.yaml)
+import os
+import sys
+
+def on_starting(server):
+    """Create the tables and seed data once in the master, before the workers are forked"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from database import db
+    db.init_database()
+    # Don't hand the master's connection down to the forked workers
+    db.close()
+    # Workers inherit the environment, so app.py knows it doesn't need to do it again
+    os.environ['DB_INITIALIZED'] = '1'